@@ -27,8 +27,16 @@ import re
 import os
 import argparse
 import json
+import functools
+import bisect
+import asyncio
+import time
+import hashlib
+import sqlite3
 
-from datasets import Dataset, load_from_disk
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset, load_from_disk, concatenate_datasets, Features, Value
 import openai
 from tqdm import tqdm
 from dotenv import load_dotenv
@@ -39,14 +47,348 @@ import tempfile
 import subprocess
 from prompts import SYSTEM_PROMPT_STANDARDIZE_LATEX, SYSTEM_PROMPT_THEOREM_QUALITY
 
+# Optional linear-time regex engine, used for the searches that scan whole papers
+try:
+    import re2
+
+    RE2_AVAILABLE = True
+except ImportError:
+    RE2_AVAILABLE = False
+
+# Optional MinHash LSH index for removing near-duplicate theorems
+try:
+    from datasketch import MinHash, MinHashLSH
+
+    DATASKETCH_AVAILABLE = True
+except ImportError:
+    DATASKETCH_AVAILABLE = False
+
 load_dotenv()
 console = Console()
 
 # Default API key - replace with your own or provide via argument
 DEFAULT_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Number of characters of LaTeX kept as context before a theorem
+DEFAULT_CONTEXT_WINDOW = 16384
+# Number of papers parsed at once by every extraction process, since a full text can take several MBs
+EXTRACTION_BATCH_SIZE = 16
+# Version of the theorem extraction, to be increased whenever its output changes so that cached extractions are not reused
+EXTRACTION_VERSION = 1
+
+
+def _compile_linear(pattern, ignore_case=False):
+    """
+    Compile a pattern with RE2 when available, which matches in linear time, and with re otherwise.
+    
+    Only meant for patterns without backreferences or lookarounds, which RE2 does not support.
+    """
+    if ignore_case:
+        pattern = '(?i)' + pattern
+    if RE2_AVAILABLE:
+        try:
+            return re2.compile(pattern)
+        except re2.error:
+            pass
+    return re.compile(pattern)
+
+
+# Declarations numbering theorems within sections, plain strings found with substring checks. They are
+# matched literally, including the \thesection.\arabic redefinitions and the [section] option of \newtheorem
+_SECTION_NUMBERING_MARKERS = (
+    r'\numberwithin{theorem}{section}',
+    r'\numberwithin{thm}{section}',
+    r'\renewcommand{\thethm}{\thesection.\arabic{thm}}',
+    r'\renewcommand{\thetheorem}{\thesection.\arabic{theorem}}',
+    r'\newtheorem{theorem}{Theorem}[section]'
+)
+# Regex patterns used to parse the LaTeX sources, compiled once at import time
+# Sections and theorem environment declarations, found together in a single scan of the document.
+# The leading backslash is factored out so that the scan only tries the alternatives after a command
+_STRUCTURE_RE = re.compile(
+    r'\\(?:section\s*(?:\[.*?\])?\s*{(?P<section_title>[^}]*)}'
+    r'|newtheorem{(?P<env_name>[^}]+)}{(?P<display_name>[^}]+)})'
+)
+_EXPLICIT_SECTION_NUM_RE = re.compile(r'^(\d+)[.\s]+')
+_LABEL_RE = re.compile(r'\\label{(.*?)}')
+_LABEL_NUMBER_RE = re.compile(r'([0-9]+(?:\.[0-9]+)?)')
+# Patterns to find theorem numbers around a theorem, fused into a single alternation.
+# The alternatives are in order of priority and each captures the number in its own named group,
+# a textual reference such as Theorem~\ref{...} matches without capturing anything. Tags and
+# references are matched in a lookahead so that they cannot hide a \label written inside them.
+_THEOREM_NUMBER_RE = re.compile(
+    # Check for \label with numbering
+    r'\\label{(?:theorem|thm)(?::|_|\-)(?P<label_sep>[0-9.]+)'
+    r'|\\label{(?:th|theorem|Theorem):?(?P<label>[0-9.]+(?:\.[0-9]+)?)'
+    # Check for theorem tag
+    r'|\\tag{(?=\(?(?P<tag>[^}]+)\)?})'
+    # Check for explicit reference in text
+    r'|(?:Theorem|theorem)[\s~]*(?:(?=\\ref{[^}]*})|(?P<text>[0-9.]+))',
+    re.IGNORECASE
+)
+_THEOREM_NUMBER_GROUPS = ('label_sep', 'label', 'tag', 'text')
+# Check for theorem numbering in text, only needed when the first textual mention is a reference
+_TEXT_THEOREM_NUMBER_RES = (
+    re.compile(r'(?:Theorem|theorem)[\s~]*([0-9]+\.[0-9]+)', re.IGNORECASE),
+    re.compile(r'(?:Theorem|theorem)[\s~]*([0-9]+)', re.IGNORECASE)
+)
+# A % starts a comment unless it is escaped as \%
+_COMMENT_RE = re.compile(r'(?<!\\)%[^\n]*')
+_NEWLINE_COLLAPSE_RE = re.compile(r'\n\s*\n+')
+# Tokens of a LaTeX statement: commands, words and single symbols
+_LATEX_TOKEN_RE = re.compile(r'\\[A-Za-z]+|\w+|\S')
+# Common patterns for custom command definitions (\newcommand, \renewcommand, \DeclareMathOperator, \def)
+_CUSTOM_COMMAND_RE = re.compile(
+    r'\\(?:re)?newcommand{\\[^}]+}(?:\[[\d]+\])?{[^}]+}'
+    r'|\\DeclareMathOperator{\\[^}]+}{[^}]+}'
+    r'|\\def\\[A-Za-z0-9]+(?:\[[^\]]*\])?{[^}]+}'
+)
+# Whitespace matched by \s of re, spelled out for the patterns compiled with RE2, whose \s only matches ASCII whitespace without \v
+_WHITESPACE_CLASS = '[\t-\r\x1c- \x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]'
+# Letters matched by a case-insensitive i of re, which also folds the dotted and dotless i onto it unlike RE2
+_CASELESS_I_CLASS = '[iİı]'
+
+# Markers of the start of an appendix, fused so that the first one is found with a single search.
+# Papers without an appendix are scanned to the end, which RE2 does much faster than re
+_APPENDIX_RE = _compile_linear('|'.join([
+    r'\\appendix',
+    r'\\section{Appendix}',
+    r'\\section{Appendices}',
+    rf'\\section{{{_WHITESPACE_CLASS}*A{_WHITESPACE_CLASS}+.*?}}',  # Section A or Appendix A
+    r'\\section{.*?Appendix.*?}',
+    r'\\begin{appendix}',
+    r'\\part{Appendix}'
+]).replace('i', _CASELESS_I_CLASS), ignore_case=True)
+
+
+@functools.lru_cache(maxsize=1024)
+def _theorem_env_pattern(env_names):
+    """
+    Compile a single pattern matching all the given theorem environments, cached since most papers share the same environments.
+    
+    Group 1 is the environment name, group 2 the explicit number (None for unnumbered theorems) and group 3 the content.
+    """
+    env_alternation = '|'.join(re.escape(env_name) for env_name in env_names)
+    return re.compile(r'\\begin{(' + env_alternation + r')}(?:\[([^]]+)\])?(.*?)\\end{\1}', re.DOTALL)
+
+
+def _find_theorem_number(surrounding_text):
+    """
+    Find an explicit theorem number in the text surrounding a theorem.
+    
+    The text is scanned once, keeping the first match of each alternative of _THEOREM_NUMBER_RE,
+    and the number of the alternative with the highest priority wins, as if each pattern had been
+    searched separately.
+    
+    Args:
+        surrounding_text (str): Text around the theorem
+        
+    Returns:
+        str: The theorem number, or None if none was found
+    """
+    first_numbers = {}
+    for number_match in _THEOREM_NUMBER_RE.finditer(surrounding_text):
+        group = number_match.lastgroup
+        # A textual reference has no number, it is recorded as None
+        first_numbers.setdefault(group or 'text', number_match.group(group) if group else None)
+        if 'label_sep' in first_numbers:
+            # Nothing can beat the highest priority alternative
+            break
+    
+    for group in _THEOREM_NUMBER_GROUPS:
+        if first_numbers.get(group):
+            return first_numbers[group]
+    
+    if 'text' in first_numbers:
+        # The first textual mention is a reference, look for a plain theorem number instead
+        for pattern in _TEXT_THEOREM_NUMBER_RES:
+            number_match = pattern.search(surrounding_text)
+            if number_match:
+                return number_match.group(1)
+    return None
+
+
+# Result used when a theorem could not be evaluated
+_DEFAULT_UNIQUENESS_RESULT = {
+    "explanation": "",
+    "single_unique_answer": "false"
+}
+
+# Result of a theorem whose evaluation hit a transient error, it is never cached so that the theorem is evaluated
+# again on the next run. Other errors would happen again, those theorems get the default result for good
+_FAILED_UNIQUENESS_RESULT = dict(_DEFAULT_UNIQUENESS_RESULT, failed=True)
+
+# Errors of the OpenAI API that may not happen again when the request is retried later
+_TRANSIENT_API_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+# Structured output schema of the uniqueness evaluation, enforced by the API so that every response has all the keys
+_UNIQUENESS_SCHEMA = {
+    "name": "theorem_uniqueness",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "single_unique_answer": {"type": "string", "enum": ["true", "false"]},
+            "explanation": {"type": "string"},
+        },
+        "required": ["single_unique_answer", "explanation"],
+        "additionalProperties": False,
+    },
+}
+
+
+def _uniqueness_request(theorem_content):
+    """
+    Build the chat completion request asking whether a theorem has a single, definitive answer.
+    
+    Shared by the per-theorem requests and the Batch API, so that both send exactly the same prompt.
+    """
+    user_prompt = f"""Please evaluate this mathematical theorem and determine if it has a single, definitive answer:
+
+                {theorem_content}
+
+                Please explain if it has a single, definitive answer. please be very strict about the theorem, if there is any ambiguity, you should deem it as 'non-unique'.
+                Return in this exact JSON format:
+                {{
+                    "single_unique_answer": "true" if the theorem has a single, definitive answer, otherwise "false"
+                    "explanation": "explanation of if this theorem has a single, definitive answer, otherwise an empty string",
+                }}
+                """
+    return {
+        "model": "o3-mini-2025-01-31",
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT_THEOREM_QUALITY},
+            {"role": "user", "content": user_prompt}
+        ],
+        "response_format": {"type": "json_schema", "json_schema": _UNIQUENESS_SCHEMA},
+        # "max_tokens": 1000
+    }
+
+
+# Test LaTeX document for a theorem, the theorem content replaces the %s slot
+_TEST_LATEX_TEMPLATE = r"""\documentclass{article}
+\usepackage{amsmath, amssymb, enumerate, amsfonts, mathrsfs, mathtools, logicproof}
+\usepackage{geometry}
+\usepackage{hyperref}
+\usepackage{xcolor}
+\usepackage{fancyhdr}
+\usepackage{tcolorbox}
+\newtheorem{theorem}{Theorem}
+\begin{document}
+\section{Theorem Test}
+
+%s
+\end{document}"""
+
+
+def _cache_key(theorem_content):
+    """Key of a theorem in the evaluation cache, the hash of its content."""
+    return hashlib.sha256(theorem_content.encode('utf-8')).hexdigest()
+
+
+def _open_evaluation_cache(cache_path):
+    """Open the SQLite cache of theorem evaluations, which several jobs can share."""
+    # The connection is also used from the thread waiting for the Batch API, never at the same time as the event loop
+    connection = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+    # Write-ahead logging lets the jobs read while another one writes, the writes are kept short by committing them at once
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS evaluations (key TEXT PRIMARY KEY, result TEXT)")
+    return connection
 
 
+def _create_test_latex(theorem_content):
+    """
+    Create a test LaTeX document with a theorem.
+    """
+    return _TEST_LATEX_TEMPLATE % theorem_content
+
+
+# Columns of the candidate theorems, declared so that papers without any theorem still give these columns
+_CANDIDATE_FEATURES = Features({
+    'paper_link': Value('string'),
+    'theorem': Value('string'),
+    'context': Value('string'),
+})
+
+# Columns of the evaluated shards, the candidates with the explanation of their evaluation
+_SHARD_FEATURES = Features({**_CANDIDATE_FEATURES, 'unique_answer_explanation': Value('string')})
+
+
+def _open_extraction_cache(cache_path):
+    """Open the SQLite cache of extracted theorems, shared by all the extraction processes."""
+    connection = sqlite3.connect(cache_path, timeout=60)
+    # Write-ahead logging lets the extraction processes read while another one writes
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS extractions (key BLOB PRIMARY KEY, theorems TEXT)")
+    return connection
+
+
+def _extraction_cache_key(latex_text, skip_appendix, context_window):
+    """Key of a paper in the extraction cache, the hash of its text and of everything else the extraction depends on."""
+    key = hashlib.blake2b(digest_size=16)
+    key.update(f"{EXTRACTION_VERSION}:{int(skip_appendix)}:{context_window}:".encode('utf-8'))
+    key.update(latex_text.encode('utf-8'))
+    return key.digest()
+
+
+def _extract_candidates(batch, skip_appendix=True, context_window=DEFAULT_CONTEXT_WINDOW, cache_path=None):
+    """
+    Extract the candidate theorems of a batch of papers, to be used with a batched Dataset.map.
+    
+    Args:
+        batch (dict): Columns of a batch of papers, with full_text and paper_link
+        skip_appendix (bool): Whether to skip theorems from appendices
+        context_window (int): Number of characters of context kept before each theorem, everything if 0
+        cache_path (str, optional): Path of the SQLite cache of extracted theorems, no cache if None
+        
+    Returns:
+        dict: Columns with one row per candidate theorem: paper_link, theorem and context
+    """
+    connection = _open_extraction_cache(cache_path) if cache_path else None
+    candidates = {'paper_link': [], 'theorem': [], 'context': []}
+    # Extractions missing from the cache, written together after the batch so that the write lock is only held briefly
+    cache_misses = []
+    for latex_text, paper_link in zip(batch['full_text'], batch['paper_link']):
+        theorems = None
+        if connection is not None:
+            key = _extraction_cache_key(latex_text, skip_appendix, context_window)
+            cached = connection.execute("SELECT theorems FROM extractions WHERE key = ?", (key,)).fetchone()
+            if cached:
+                theorems = json.loads(cached[0])
+        if theorems is None:
+            theorems = [
+                {'content': theorem['content'], 'context': theorem['context']}
+                for theorem in TheoremExtractor.extract_paper_theorems(latex_text, skip_appendix, context_window)
+            ]
+            if connection is not None:
+                cache_misses.append((key, json.dumps(theorems)))
+        
+        for theorem in theorems:
+            candidates['paper_link'].append(paper_link)
+            candidates['theorem'].append(theorem['content'])
+            candidates['context'].append(theorem['context'])
+    
+    if connection is not None:
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO extractions VALUES (?, ?)", cache_misses)
+        except sqlite3.Error as e:
+            # The extractions are still returned, they are only not cached
+            console.print(f"[yellow]Could not cache the extracted theorems: {e}[/yellow]")
+        connection.close()
+    return candidates
+
+
+def _print_panel(text, title, border_style):
+    """
+    Print a text in a rich Panel on a terminal, and as plain lines when the output goes to a log file.
+    """
+    if console.is_terminal:
+        console.print(Panel(text, title=title, border_style=border_style))
+    else:
+        console.print(f"{title}: {text}")
+
 
 def setup_random_seed(seed=42):
     """
@@ -58,6 +400,54 @@ def setup_random_seed(seed=42):
     np.random.seed(seed)
 
 
+def _cgroup_cpu_limit():
+    """
+    Number of CPUs allowed by the cgroup CPU quota of this process, None without a quota.
+    
+    Reads the cgroup v2 cpu.max file, e.g. "200000 100000" for 2 CPUs or "max 100000" without a quota,
+    and otherwise the cgroup v1 cpu.cfs_quota_us and cpu.cfs_period_us files, where a quota of -1 means none.
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    try:
+        quota, period = int(quota), int(period)
+    except ValueError:
+        # "max" without a cgroup v2 quota
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return max(1, quota // period)
+
+
+def available_cpu_count():
+    """
+    Number of CPUs this process may actually use.
+    
+    os.cpu_count() returns the cores of the whole machine, even when a scheduler such as SLURM or
+    Kubernetes only gives the process some of them through its CPU affinity or a cgroup CPU quota.
+    
+    Returns:
+        int: Number of usable CPUs, at least 1
+    """
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count() or 1
+    cpu_limit = _cgroup_cpu_limit()
+    if cpu_limit is not None:
+        cpu_count = min(cpu_count, cpu_limit)
+    return cpu_count
+
+
 
 
 class TheoremExtractor:
@@ -70,14 +460,41 @@ class TheoremExtractor:
     3. Process datasets of mathematics papers
     """
     
-    def __init__(self):
+    def __init__(self, max_parallel=20, cache_path=None):
         """
         Initialize the TheoremExtractor.
+        
+        Args:
+            max_parallel (int): Maximum number of concurrent OpenAI requests
+            cache_path (str, optional): Path of the SQLite cache of theorem evaluations, no cache if None
         """
         self.api_key = DEFAULT_API_KEY
         self.client = openai.OpenAI(api_key=self.api_key)
+        self.aclient = openai.AsyncOpenAI(api_key=self.api_key)
+        self.max_parallel = max_parallel
+        # Evaluations keyed by the hash of the theorem content, so that repeated theorems and re-runs are free
+        self.cache = _open_evaluation_cache(cache_path) if cache_path else None
+
+    def _cached_result(self, key):
+        """Cached evaluation of the theorem with this cache key, None if it was not evaluated yet."""
+        if self.cache is None:
+            return None
+        cached = self.cache.execute("SELECT result FROM evaluations WHERE key = ?", (key,)).fetchone()
+        return json.loads(cached[0]) if cached else None
+
+    def _cache_result(self, key, result):
+        """Store the evaluation of a theorem in the cache, the caller commits it."""
+        if self.cache is not None:
+            self.cache.execute("INSERT OR REPLACE INTO evaluations VALUES (?, ?)", (key, json.dumps(result)))
 
-    def extract_theorems(self, latex_text):
+    def close(self):
+        """Close the evaluation cache."""
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    @staticmethod
+    def extract_theorems(latex_text):
         """
         Extract theorems from LaTeX text.
         
@@ -89,31 +506,29 @@ class TheoremExtractor:
         """
         def _detect_section_numbering(latex_text):
             """Helper method to detect if the document uses section-based theorem numbering."""
-            numbering_patterns = [
-                r'\\numberwithin{theorem}{section}',
-                r'\\numberwithin{thm}{section}',
-                r'\\renewcommand{\\thethm}{\\thesection\\.\\arabic{thm}}',
-                r'\\renewcommand{\\thetheorem}{\\thesection\\.\\arabic{theorem}}',
-                r'\\newtheorem{theorem}{Theorem}[section]'
-            ]
-            
-            for pattern in numbering_patterns:
-                if re.search(pattern, latex_text):
-                    return True
-            return False
+            return any(marker in latex_text for marker in _SECTION_NUMBERING_MARKERS)
+        
+        def _scan_structure(latex_text):
+            """Helper method to find the sections and the theorem environment declarations in a single scan."""
+            section_matches = []
+            newtheorem_matches = []
+            for match in _STRUCTURE_RE.finditer(latex_text):
+                if match.group('section_title') is not None:
+                    section_matches.append(match)
+                else:
+                    newtheorem_matches.append(match)
+            return section_matches, newtheorem_matches
         
-        def _extract_section_data(latex_text):
+        def _extract_section_data(section_matches):
             """Helper method to extract section numbers and positions."""
             section_data = []
-            section_pattern = r'\\section\s*(?:\[.*?\])?\s*{([^}]*)}'
-            section_matches = re.finditer(section_pattern, latex_text)
             
             current_section_num = 0
             for match in section_matches:
                 current_section_num += 1
                 # Some papers might explicitly number sections like \section{2. Main Results}
-                section_title = match.group(1)
-                explicit_num_match = re.match(r'^(\d+)[.\s]+', section_title)
+                section_title = match.group('section_title')
+                explicit_num_match = _EXPLICIT_SECTION_NUM_RE.match(section_title)
                 if explicit_num_match:
                     explicit_num = int(explicit_num_match.group(1))
                     if explicit_num > 0:  # Only use valid section numbers
@@ -127,19 +542,17 @@ class TheoremExtractor:
             
             return section_data
         
-        def _get_theorem_patterns(latex_text):
-            """Helper method to define theorem patterns and find custom environments."""
-            # Base patterns for standard theorem environments
-            patterns = {'theorem': r'\\begin{theorem}(.*?)\\end{theorem}'}
-            numbered_patterns = {'theorem': r'\\begin{theorem}\[([^]]+)\](.*?)\\end{theorem}'}
+        def _get_theorem_environments(newtheorem_matches):
+            """Helper method to find the theorem environments, including custom ones."""
+            # Standard theorem environment
+            env_names = ['theorem']
             
             # Find custom theorem environments
             custom_theorem_envs = []
-            custom_pattern = r'\\newtheorem{([^}]+)}{([^}]+)}'
             
-            for match in re.finditer(custom_pattern, latex_text):
-                env_name = match.group(1)
-                display_name = match.group(2)
+            for match in newtheorem_matches:
+                env_name = match.group('env_name')
+                display_name = match.group('display_name')
                 
                 if 'theorem' in env_name.lower() or 'theorem' in display_name.lower():
                     custom_theorem_envs.append({
@@ -147,241 +560,174 @@ class TheoremExtractor:
                         'display_name': display_name
                     })
                     
-                    # Add custom environment patterns
-                    patterns[env_name] = r'\\begin{' + env_name + r'}(.*?)\\end{' + env_name + r'}'
-                    numbered_patterns[env_name] = r'\\begin{' + env_name + r'}\[([^]]+)\](.*?)\\end{' + env_name + r'}'
+                    if env_name not in env_names:
+                        env_names.append(env_name)
             
-            return patterns, numbered_patterns, custom_theorem_envs
+            return env_names, custom_theorem_envs
         
-        def _extract_numbered_theorems(latex_text, numbered_patterns, custom_theorem_envs):
+        def _extract_all_theorems(latex_text, theorem_pattern, custom_theorem_envs,
+                                  section_data, section_numbering, theorem_counters):
             """
-            Extract explicitly numbered theorems from LaTeX text.
+            Extract the theorems of all environments from LaTeX text in a single pass.
             
-            Args:
-                latex_text (str): LaTeX text to process
-                numbered_patterns (dict): Patterns for numbered theorems
-                custom_theorem_envs (list): Custom theorem environments
-                
-            Returns:
-                list: List of extracted theorems
-            """
-            results = []
-            
-            for env_type, pattern in numbered_patterns.items():
-                matches = re.finditer(pattern, latex_text, re.DOTALL)
-                for match in matches:
-                    number = match.group(1).strip()
-                    content = match.group(2).strip()
-                    start_pos = match.start()
-                    end_pos = match.end()
-                    
-                    # Try to extract label if present
-                    label_match = re.search(r'\\label{(.*?)}', content)
-                    label = label_match.group(1) if label_match else None
-                    
-                    # Remove label from content if found
-                    if label_match:
-                        content = content.replace(label_match.group(0), '').strip()
-                    
-                    # Create display name based on type of environment
-                    display_name = "Theorem"  # Default
-                    if env_type != 'theorem':
-                        for env in custom_theorem_envs:
-                            if env['env_name'] == env_type:
-                                display_name = env['display_name']
-                                break
-                    
-                    # Create display label with the explicitly provided number
-                    display_label = f"{display_name} {number}"
-                    
-                    results.append({
-                        'type': env_type,
-                        'label': label,
-                        'display_label': display_label,
-                        'content': content,
-                        'start_pos': start_pos,
-                        'end_pos': end_pos
-                    })
-                    
-            return results
-        
-        def _extract_regular_theorems(latex_text, patterns, custom_theorem_envs, 
-                                   section_data, section_numbering, theorem_counters):
-            """
-            Extract regular (unnumbered) theorems from LaTeX text.
+            Explicitly numbered theorems (e.g. \\begin{theorem}[2.1]) keep their number, while the
+            number of regular theorems is inferred from labels, references or the theorem counters.
             
             Args:
                 latex_text (str): LaTeX text to process
-                patterns (dict): Patterns for regular theorems
+                theorem_pattern (re.Pattern): Pattern matching all theorem environments
                 custom_theorem_envs (list): Custom theorem environments
                 section_data (list): Section information
                 section_numbering (bool): Whether section-based numbering is used
                 theorem_counters (dict): Counters for each theorem environment
                 
             Returns:
-                list: List of extracted theorems
+                list: List of extracted theorems, in document order
             """
             results = []
+            # Section start positions, sorted since sections are found in document order
+            section_positions = [section['position'] for section in section_data]
             
-            for env_type, pattern in patterns.items():
-                matches = re.finditer(pattern, latex_text, re.DOTALL)
-                for match in matches:
-                    content = match.group(1).strip()
-                    start_pos = match.start()
-                    end_pos = match.end()
-                    
-                    # Try to extract label if present
-                    label_match = re.search(r'\\label{(.*?)}', content)
-                    label = label_match.group(1) if label_match else None
-                    
-                    # Remove label from content if found
-                    if label_match:
-                        content = content.replace(label_match.group(0), '').strip()
-                    
-                    # Create display name based on type of environment
-                    display_name = "Theorem"  # Default
-                    if env_type != 'theorem':
-                        for env in custom_theorem_envs:
-                            if env['env_name'] == env_type:
-                                display_name = env['display_name']
-                                break
-                    
-                    # Determine the current section for this theorem
-                    current_section = None
-                    if section_numbering and section_data:
-                        for i, section in enumerate(section_data):
-                            if section['position'] < start_pos:
-                                current_section = section
-                            else:
-                                # We've gone past the current section
-                                break
-                    
-                    # Increment the counter for this type of theorem
-                    theorem_counters[env_type] += 1
-                    
-                    # Look for explicit theorem number in a larger surrounding context
-                    surrounding_text = latex_text[max(0, start_pos-1000):min(len(latex_text), end_pos+1000)]
-                    
-                    # Set of patterns to find theorem numbers
-                    num_patterns = [
-                        # Check for theorem reference with label
-                        (r'\\ref{' + re.escape(label) + r'}[\s\n]*([0-9.]+)', lambda m: m.group(1)) if label else (None, None),
-                        # Check for \label with numbering
-                        (r'\\label{(?:theorem|thm)(?::|_|\-)([0-9.]+)', lambda m: m.group(1)),
-                        (r'\\label{(?:th|theorem|Theorem):?([0-9.]+(?:\.[0-9]+)?)', lambda m: m.group(1)),
-                        # Check for theorem tag
-                        (r'\\tag{\(?([^}]+)\)?}', lambda m: m.group(1)),
-                        # Check for explicit reference in text
-                        (r'(?:Theorem|theorem)[\s~]*(?:\\ref{[^}]*}|([0-9.]+))', lambda m: m.group(1) if m.group(1) else None),
-                        # Check for theorem numbering in text
-                        (r'(?:Theorem|theorem)[\s~]*([0-9]+\.[0-9]+)', lambda m: m.group(1)),
-                        (r'(?:Theorem|theorem)[\s~]*([0-9]+)', lambda m: m.group(1))
-                    ]
-                    
-                    # Try all patterns to find a theorem number
-                    theorem_number = None
-                    for pattern, extract in num_patterns:
-                        if pattern is None:
-                            continue
-                        number_match = re.search(pattern, surrounding_text, re.IGNORECASE)
-                        if number_match and extract(number_match):
-                            theorem_number = extract(number_match)
+            for match in theorem_pattern.finditer(latex_text):
+                env_type = match.group(1)
+                number = match.group(2)
+                content = match.group(3).strip()
+                start_pos = match.start()
+                end_pos = match.end()
+                
+                # Try to extract label if present
+                label_match = _LABEL_RE.search(content)
+                label = label_match.group(1) if label_match else None
+                
+                # Remove label from content if found, slicing around the match instead of searching for it again
+                if label_match:
+                    content = (content[:label_match.start()] + content[label_match.end():]).strip()
+                
+                # Create display name based on type of environment
+                display_name = "Theorem"  # Default
+                if env_type != 'theorem':
+                    for env in custom_theorem_envs:
+                        if env['env_name'] == env_type:
+                            display_name = env['display_name']
                             break
-                    
-                    # If we have a label but couldn't find a number, try to extract it from the label
-                    if not theorem_number and label:
-                        label_number_match = re.search(r'([0-9]+(?:\.[0-9]+)?)', label)
-                        if label_number_match:
-                            theorem_number = label_number_match.group(1)
-                    
-                    # Default to section based numbering if enabled
-                    if not theorem_number and section_numbering and current_section:
-                        theorem_number = f"{current_section['number']}.{theorem_counters[env_type]}"
-                    elif not theorem_number:
-                        # Use simple counter if nothing else worked
-                        theorem_number = str(theorem_counters[env_type])
-                    
-                    # Create the final display label
-                    display_label = f"{display_name} {theorem_number}"
-                    
+                
+                # Increment the counter for this type of theorem, numbered theorems are counted too
+                theorem_counters[env_type] += 1
+                
+                if number is not None:
+                    # Create display label with the explicitly provided number
                     results.append({
                         'type': env_type,
                         'label': label,
-                        'display_label': display_label,
+                        'display_label': f"{display_name} {number.strip()}",
                         'content': content,
                         'start_pos': start_pos,
                         'end_pos': end_pos
                     })
-                    
+                    continue
+                
+                # Determine the current section for this theorem
+                current_section = None
+                if section_numbering and section_data:
+                    # Last section starting before the theorem
+                    section_index = bisect.bisect_left(section_positions, start_pos) - 1
+                    if section_index >= 0:
+                        current_section = section_data[section_index]
+                
+                # Look for explicit theorem number in a larger surrounding context
+                surrounding_text = latex_text[max(0, start_pos-1000):min(len(latex_text), end_pos+1000)]
+                
+                theorem_number = None
+                # Check for theorem reference with label, only compiling the pattern if the reference is there
+                if label and '\\ref{' + label + '}' in surrounding_text:
+                    number_match = re.search(r'\\ref{' + re.escape(label) + r'}[\s\n]*([0-9.]+)', surrounding_text, re.IGNORECASE)
+                    if number_match:
+                        theorem_number = number_match.group(1)
+                
+                # Then try all the other patterns to find a theorem number
+                if not theorem_number:
+                    theorem_number = _find_theorem_number(surrounding_text)
+                
+                # If we have a label but couldn't find a number, try to extract it from the label
+                if not theorem_number and label:
+                    label_number_match = _LABEL_NUMBER_RE.search(label)
+                    if label_number_match:
+                        theorem_number = label_number_match.group(1)
+                
+                # Default to section based numbering if enabled
+                if not theorem_number and section_numbering and current_section:
+                    theorem_number = f"{current_section['number']}.{theorem_counters[env_type]}"
+                elif not theorem_number:
+                    # Use simple counter if nothing else worked
+                    theorem_number = str(theorem_counters[env_type])
+                
+                # Create the final display label
+                display_label = f"{display_name} {theorem_number}"
+                
+                results.append({
+                    'type': env_type,
+                    'label': label,
+                    'display_label': display_label,
+                    'content': content,
+                    'start_pos': start_pos,
+                    'end_pos': end_pos
+                })
+                
             return results
             
         # Analyze document for section numbering
         section_numbering = _detect_section_numbering(latex_text)
         
+        # Find the sections and the theorem environment declarations
+        section_matches, newtheorem_matches = _scan_structure(latex_text)
+        
         # Extract sections and their positions
-        section_data = _extract_section_data(latex_text)
+        section_data = _extract_section_data(section_matches)
         
-        # Define patterns for theorems and find custom theorem environments
-        patterns, numbered_patterns, custom_theorem_envs = _get_theorem_patterns(latex_text)
+        # Find the theorem environments and build one pattern matching all of them
+        env_names, custom_theorem_envs = _get_theorem_environments(newtheorem_matches)
+        theorem_pattern = _theorem_env_pattern(tuple(env_names))
         
         # Initialize theorem counters
-        theorem_counters = {env_name: 0 for env_name in patterns.keys()}
-        
-        results = []
+        theorem_counters = {env_name: 0 for env_name in env_names}
         
-        # Process explicitly numbered theorems first
-        numbered_theorems = _extract_numbered_theorems(
-            latex_text, numbered_patterns, custom_theorem_envs)
-        
-        results.extend(numbered_theorems)
-        # process regular theorems, which are not numbered
-        regular_theorems = _extract_regular_theorems(
-            latex_text, patterns, custom_theorem_envs, section_data, 
+        # A single scan yields each theorem once and in document order, so there are no
+        # duplicates between numbered and regular theorems to filter out and nothing to sort
+        results = _extract_all_theorems(
+            latex_text, theorem_pattern, custom_theorem_envs, section_data,
             section_numbering, theorem_counters)
-        results.extend(regular_theorems)
-        
-        #! check if the end_pos is the same for some duplicates, filter them out
-        num_removed = 0
-        end_pos_cache = set()
-        for result in results:
-            if result['end_pos'] in end_pos_cache:
-                #! remove the duplicate
-                results.remove(result)
-                num_removed += 1
-            else:
-                end_pos_cache.add(result['end_pos'])
-        if num_removed > 0:
-            console.print(f"[bold green]Removed {num_removed} duplicates[/bold green]")
-        # Sort by position in the document
-        results.sort(key=lambda x: x['start_pos'])
-
 
         return results
     
-    def get_context_before(self, latex_text, position):
+    @staticmethod
+    def get_context_before(latex_text, position, window=DEFAULT_CONTEXT_WINDOW):
         """
         Get the context before a given position in the LaTeX text, including all content.
         
+        Only the last window characters are kept, so that every theorem does not store a copy of
+        the whole beginning of its paper.
+        
         Args:
             latex_text (str): LaTeX text to process
             position (int): Position to get context before
+            window (int): Number of characters before the position to keep, everything if 0
             
         Returns:
             str: Context text
         """
-        # Start from the beginning of the file
-        start_pos = 0
+        # Start window characters before the position, or from the beginning of the file
+        start_pos = max(0, position - window) if window else 0
         
         # Get the text between start_pos and position without filtering
         context = latex_text[start_pos:position]
         
-        # Clean up whitespace and normalize spacing
-        context = re.sub(r'\s+', ' ', context)
-        context = context.strip()
+        # Clean up whitespace and normalize spacing, splitting on whitespace also strips both ends
+        context = ' '.join(context.split())
 
         return context
 
-    def remove_latex_comments(self, latex_text):
+    @staticmethod
+    def remove_latex_comments(latex_text):
         """
         Remove LaTeX comments from the text.
         
@@ -391,22 +737,12 @@ class TheoremExtractor:
         
         Returns the LaTeX text with all comments removed.
         """
-        # Use regex to remove comments but preserve escaped % characters
-        # First, temporarily replace escaped % with a unique marker
-        text = re.sub(r'\\%', 'ESCAPED_PERCENT_PLACEHOLDER', latex_text)
-        
-        # Remove comments (% to end of line)
-        text = re.sub(r'%.*?(?:\n|$)', '\n', text)
-        
-        # Restore escaped % characters
-        text = re.sub(r'ESCAPED_PERCENT_PLACEHOLDER', '\\%', text)
-        
-        # Clean up excessive newlines that might have been created
-        text = re.sub(r'\n\s*\n+', '\n\n', text)
-        
-        return text
+        # Remove comments (% to end of line) in a single pass, the lookbehind skips escaped % characters,
+        # then clean up excessive newlines that might have been created
+        return _NEWLINE_COLLAPSE_RE.sub('\n\n', _COMMENT_RE.sub('', latex_text))
 
-    def extract_custom_commands(self, latex_text):
+    @staticmethod
+    def extract_custom_commands(latex_text):
         """
         Extract custom LaTeX command definitions from the text.
         
@@ -416,292 +752,606 @@ class TheoremExtractor:
         Returns:
             str: Extracted custom command definitions
         """
-        # Common patterns for custom command definitions
-        command_patterns = [
-            r'\\newcommand{\\[^}]+}(\[[\d]+\])?{[^}]+}',
-            r'\\DeclareMathOperator{\\[^}]+}{[^}]+}',
-            r'\\def\\[A-Za-z0-9]+(\[[^\]]*\])?{[^}]+}',
-            r'\\renewcommand{\\[^}]+}(\[[\d]+\])?{[^}]+}'
-        ]
-        
-        # Extract all matching custom commands
-        custom_commands = []
-        for pattern in command_patterns:
-            matches = re.findall(pattern, latex_text)
-            if matches:
-                for match in re.finditer(pattern, latex_text):
-                    custom_commands.append(match.group(0))
-        
-        # Return as a string with one command per line
-        return '\n'.join(custom_commands)
-
-    def evaluate_theorem_uniqueness(self, theorem_content):
+        # Extract all matching custom commands in document order, returned as a string with one command per line
+        return '\n'.join(match.group(0) for match in _CUSTOM_COMMAND_RE.finditer(latex_text))
+
+    async def evaluate_theorem_uniqueness(self, theorem_content, max_retries=5, initial_timeout=3):
         """
         Use o3-mini-2025-01-31 to evaluate if a theorem has a single, definitive answer.
         
         Args:
             theorem_content (str): The content of the theorem
+            max_retries (int): Maximum number of retries when the API is rate limited
+            initial_timeout (int): Initial backoff in seconds, doubled after every rate limited attempt
             
         Returns:
             tuple: (single_unique_answer, theorem, explanation)
         """
-        default_result = {
-            "explanation": "",
-            "single_unique_answer": "false"
-        }
+        default_result = dict(_DEFAULT_UNIQUENESS_RESULT)
+        key = _cache_key(theorem_content)
+        cached = self._cached_result(key)
+        if cached is not None:
+            return cached
         try:
-            # call the model untill we are not missing any keys
-            user_prompt = f"""Please evaluate this mathematical theorem and determine if it has a single, definitive answer:
-
-                {theorem_content}
-
-                Please explain if it has a single, definitive answer. please be very strict about the theorem, if there is any ambiguity, you should deem it as 'non-unique'.
-                Return in this exact JSON format:
-                {{
-                    "single_unique_answer": "true" if the theorem has a single, definitive answer, otherwise "false"
-                    "explanation": "explanation of if this theorem has a single, definitive answer, otherwise an empty string",
-                }}
-                """
-            # make sure that the result has all the keys
-            iteration = 0
+            # call the model once, the response schema guarantees that the result has all the keys
+            request = _uniqueness_request(theorem_content)
+            retries = 0
+            backoff_time = initial_timeout
             while True:
-                iteration += 1
-                response = self.client.chat.completions.create(
-                    model="o3-mini-2025-01-31",
-                    messages=[
-                        {"role": "system", "content": SYSTEM_PROMPT_THEOREM_QUALITY},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    response_format={"type": "json_object"},
-                    # max_tokens=1000
-                )
-                response_content = response.choices[0].message.content
-                result = json.loads(response_content)
-                # check if all the keys are present
-                if all(key in result for key in default_result.keys()):
+                try:
+                    response = await self.aclient.chat.completions.create(**request)
                     break
-                if iteration > 5:
-                    console.print(f"[bold red]Stupid model, still not returning the correct keys when evaluating theorem uniqueness[/bold red]")
-                    return default_result
-            # once we get the result from the model, just return it   
+                except openai.RateLimitError:
+                    if retries >= max_retries:
+                        raise
+                    retries += 1
+                    await asyncio.sleep(backoff_time)
+                    backoff_time *= 2
+            result = json.loads(response.choices[0].message.content)
+            # once we get the result from the model, cache it and return it
+            if self.cache is not None:
+                self._cache_result(key, result)
+                self.cache.commit()
             return result
+        except _TRANSIENT_API_ERRORS as e:
+            console.print(f"[bold red]Calling GPT models failed, the theorem will be evaluated again: {e}[/bold red]")
+            return dict(_FAILED_UNIQUENESS_RESULT)
         except Exception as e:
             console.print(f"[bold red]Calling GPT models failed: {e}[/bold red]")
+            # The same request would fail again, so the theorem is cached as non-unique
+            if self.cache is not None:
+                self._cache_result(key, default_result)
+                self.cache.commit()
             return default_result
+
+    async def evaluate_theorems(self, theorem_contents):
+        """
+        Evaluate the uniqueness of several theorems concurrently, with at most max_parallel requests in flight.
+        
+        Identical theorems are evaluated only once.
+        
+        Args:
+            theorem_contents (list): The contents of the theorems
+            
+        Returns:
+            list: Evaluation results, in the same order as theorem_contents
+        """
+        semaphore = asyncio.BoundedSemaphore(self.max_parallel)
+
+        async def _evaluate(theorem_content):
+            async with semaphore:
+                return await self.evaluate_theorem_uniqueness(theorem_content)
+
+        distinct_contents = list(dict.fromkeys(theorem_contents))
+        distinct_results = await asyncio.gather(*[_evaluate(theorem_content) for theorem_content in distinct_contents])
+        results = dict(zip(distinct_contents, distinct_results))
+        return [dict(results[theorem_content]) for theorem_content in theorem_contents]
+
+    def evaluate_theorem_batches(self, theorem_contents_lists, poll_interval=60):
+        """
+        Evaluate the uniqueness of several lists of theorems with the OpenAI Batch API, one batch per list.
+        
+        The Batch API is cheaper than individual requests and has no per-request latency, which suits
+        offline dataset construction. All the batches are submitted before waiting for any of them, so
+        that they run at the same time instead of one turnaround after the other. Only theorems missing
+        from the cache are submitted, once per distinct content in each list. Theorems whose request
+        failed are deemed non-unique, and marked as failed when the error is transient.
+        
+        Args:
+            theorem_contents_lists (list): Lists of the contents of the theorems, each evaluated in its own batch
+            poll_interval (int): Seconds to wait between two status checks of the batches
+            
+        Returns:
+            list: Lists of evaluation results, in the same order as theorem_contents_lists
+        """
+        results_lists = []
+        # Submitted batches, with the results they fill and the indices of their theorems grouped by content
+        submitted = []
+        for theorem_contents in theorem_contents_lists:
+            results = [dict(_FAILED_UNIQUENESS_RESULT) for _ in theorem_contents]
+            results_lists.append(results)
+            
+            # Indices of the theorems still to evaluate, grouped by content
+            pending = {}
+            for i, theorem_content in enumerate(theorem_contents):
+                cached = self._cached_result(_cache_key(theorem_content))
+                if cached is not None:
+                    results[i] = cached
+                else:
+                    pending.setdefault(theorem_content, []).append(i)
+            if not pending:
+                continue
+            pending_contents = list(pending)
+            
+            # One request per distinct theorem, the custom_id is its index in pending_contents
+            batch_requests = [
+                json.dumps({
+                    "custom_id": str(j),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": _uniqueness_request(theorem_content),
+                })
+                for j, theorem_content in enumerate(pending_contents)
+            ]
+            try:
+                batch_file = self.client.files.create(
+                    file=("theorem_uniqueness_batch.jsonl", "\n".join(batch_requests).encode("utf-8")),
+                    purpose="batch"
+                )
+                batch = self.client.batches.create(
+                    input_file_id=batch_file.id,
+                    endpoint="/v1/chat/completions",
+                    completion_window="24h"
+                )
+            except Exception as e:
+                console.print(f"[bold red]Calling GPT models failed: {e}[/bold red]")
+                continue
+            console.print(f"[bold]Submitted batch {batch.id} with {len(batch_requests)} theorems[/bold]")
+            submitted.append((batch, results, pending, pending_contents))
         
-      
-    def process_paper(self, latex_text, skip_appendix=True, paper_link=""):
+        if submitted:
+            console.print(f"[bold]Waiting for {len(submitted)} batches to complete[/bold]")
+        for batch, results, pending, pending_contents in submitted:
+            try:
+                # The batches run at the same time, so waiting for them in turn takes as long as the slowest one
+                while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                    time.sleep(poll_interval)
+                    batch = self.client.batches.retrieve(batch.id)
+                
+                if batch.status != "completed":
+                    console.print(f"[bold red]Batch {batch.id} ended with status {batch.status}[/bold red]")
+                # Expired or cancelled batches still return the requests that were completed
+                if not batch.output_file_id:
+                    continue
+                batch_output = self.client.files.content(batch.output_file_id).text
+            except Exception as e:
+                console.print(f"[bold red]Calling GPT models failed: {e}[/bold red]")
+                continue
+            
+            for line in batch_output.splitlines():
+                item = json.loads(line)
+                response = item.get("response")
+                status_code = response.get("status_code") if response else None
+                # Requests that the batch did not run, were rate limited or hit a server error are evaluated again on the next run
+                if status_code is None or status_code == 429 or status_code >= 500:
+                    continue
+                result = None
+                if status_code == 200:
+                    try:
+                        result = json.loads(response["body"]["choices"][0]["message"]["content"])
+                    except (KeyError, IndexError, TypeError, json.JSONDecodeError):
+                        pass
+                # Other failed requests would fail again, so the theorem is cached as non-unique
+                if not isinstance(result, dict) or not all(key in result for key in _UNIQUENESS_SCHEMA["schema"]["required"]):
+                    result = dict(_DEFAULT_UNIQUENESS_RESULT)
+                theorem_content = pending_contents[int(item["custom_id"])]
+                for i in pending[theorem_content]:
+                    results[i] = dict(result)
+                self._cache_result(_cache_key(theorem_content), result)
+            
+            if self.cache is not None:
+                self.cache.commit()
+        return results_lists
+
+    @classmethod
+    def extract_paper_theorems(cls, latex_text, skip_appendix=True, context_window=DEFAULT_CONTEXT_WINDOW):
         """
-        Process a LaTeX paper to extract high-quality theorems.
+        Extract the candidate theorems of a LaTeX paper, together with their context.
+        
+        This only parses the LaTeX text and does not call any model, so it can run in worker processes.
         
         Args:
             latex_text (str): The LaTeX text to process
             skip_appendix (bool): Whether to skip theorems from appendices
-            paper_link (str): Link to the original paper
+            context_window (int): Number of characters of context kept before each theorem, everything if 0
             
         Returns:
-            list: List of single, definitive theorems extracted from the paper
+            list: List of theorems, each with its content and the context before it
         """
         # Remove comments from LaTeX text
-        custom_commands = self.extract_custom_commands(latex_text)
-        latex_text = self.remove_latex_comments(latex_text)
+        custom_commands = cls.extract_custom_commands(latex_text)
+        latex_text = cls.remove_latex_comments(latex_text)
         
         def _skip_appendix(latex_text):
             # If skip_appendix is True, extract only the main text by finding the appendix start position
             if skip_appendix:
-                # Detect appendix sections in the document
-                appendix_positions = []
-                appendix_patterns = [
-                    r'\\appendix',
-                    r'\\section{Appendix}',
-                    r'\\section{Appendices}',
-                    r'\\section{\s*A\s+.*?}',  # Section A or Appendix A
-                    r'\\section{.*?Appendix.*?}',
-                    r'\\begin{appendix}',
-                    r'\\part{Appendix}'
-                ]
+                # Detect the first appendix marker in the document, the search stops there
+                appendix_match = _APPENDIX_RE.search(latex_text)
                 
-                for pattern in appendix_patterns:
-                    for match in re.finditer(pattern, latex_text, re.IGNORECASE):
-                        appendix_positions.append(match.start())
-                
-                # If we found appendix markers, truncate the latex_text to only include content before the appendix
-                if appendix_positions:
-                    appendix_start = min(appendix_positions)
-                    latex_text = latex_text[:appendix_start]
+                # If we found an appendix marker, truncate the latex_text to only include content before the appendix
+                if appendix_match:
+                    latex_text = latex_text[:appendix_match.start()]
             return latex_text
         
         latex_text = _skip_appendix(latex_text)
         
         # Extract theorems from the (possibly truncated) latex text
-        theorems = self.extract_theorems(latex_text)
-        num_theorems = len(theorems)
+        theorems = cls.extract_theorems(latex_text)
         
-        if num_theorems == 0:
-            console.print(f"[yellow]No theorems found in the paper, skipping[/yellow]")
-            return [], 0
-            
-        high_quality_theorems = []
-        
-        # Function to create a test LaTeX document with a theorem
-        def _create_test_latex(theorem_content):
-            return r"""\documentclass{article}
-                \usepackage{amsmath, amssymb, enumerate, amsfonts, mathrsfs, mathtools, logicproof}
-                \usepackage{geometry}
-                \usepackage{hyperref}
-                \usepackage{xcolor}
-                \usepackage{fancyhdr}
-                \usepackage{tcolorbox}
-                \newtheorem{theorem}{Theorem}
-                \begin{document}
-                \section{Theorem Test}
-                
-                """ + theorem_content + r"""
-                \end{document}"""
-        
-        for i, theorem in enumerate(theorems):
-            console.print(f"[bold]Processing theorem {i+1}/{num_theorems}[/bold]")
-            
+        for theorem in theorems:
             # Get context before the theorem
-            context = self.get_context_before(latex_text, theorem['start_pos'])
-            # Evaluate theorem quality - now returns is_high_quality, theorem text, and explanation
-            result_unique = self.evaluate_theorem_uniqueness(theorem['content'])
-            if result_unique['single_unique_answer'] == "false":
-                console.print(f"[yellow]Theorem {i+1} does not have a single, definitive answer, skipping[/yellow]")
-                continue
-            
-            formatted_theorem = theorem['content']
-
-            # finally, we filter out samples that don't have a single, definitive answer, and cannot be compiled
-            high_quality_theorems.append({
-                "paper_link": paper_link,
-                "theorem": formatted_theorem,
-                "context": context,
-                "unique_answer_explanation": result_unique['explanation'],
-            })
-
-        return high_quality_theorems, num_theorems
+            theorem['context'] = cls.get_context_before(latex_text, theorem['start_pos'], context_window)
+        
+        return theorems
 
-    def process_dataset(self, input_path, output_path, sample_papers=None, skip_appendix=True):
+    def process_dataset(self, input_path, output_path, sample_papers=None, skip_appendix=True, use_batch_api=False,
+                        num_proc=None, shard_size=5000, shards_path=None, context_window=DEFAULT_CONTEXT_WINDOW,
+                        num_jobs=1, job_index=0, near_duplicate_threshold=None, extraction_cache_path=None):
         """
         Process a dataset of LaTeX papers.
         
+        The candidate theorems of all papers are extracted first, in parallel across papers, deduplicated,
+        and then evaluated shard by shard, either concurrently or through the OpenAI Batch API. Every evaluated
+        shard is saved next to the output once all its theorems were evaluated, so an interrupted run resumes
+        from the first missing shard.
+        
         Args:
             input_path (str): Path to the input dataset
             output_path (str): Path to save the output dataset
             sample_papers (int, optional): Number of papers to process
             skip_appendix (bool): Whether to skip theorems from appendices
+            use_batch_api (bool): Whether to evaluate the theorems with the OpenAI Batch API
+            num_proc (int, optional): Number of processes extracting theorems
+            shard_size (int): Number of theorems evaluated and saved together
+            shards_path (str, optional): Directory of the evaluated shards, next to the output by default
+            context_window (int): Number of characters of context kept before each theorem, everything if 0
+            num_jobs (int): Number of jobs splitting the papers between them, for example on several machines
+            job_index (int): Index of this job, which only processes its own contiguous part of the papers
+            near_duplicate_threshold (float, optional): Similarity above which theorems are near-duplicates, only exact duplicates are removed if None
+            extraction_cache_path (str, optional): Path of the SQLite cache of extracted theorems, no cache if None
             
         Returns:
             Dataset: Dataset of high-quality theorems extracted from the papers
         """
-        # Initialize empty result containers
-        all_ids = []
-        all_paper_links = []
-        all_contexts = []
-        all_theorems = []
-        all_unique_answer_explanations = []
         input_dataset = load_from_disk(input_path)
-        # Shuffle the dataset
-        input_dataset = input_dataset.shuffle(seed=42)
-        
         console.print(f"[green]Loaded {len(input_dataset)} papers from {input_path}[/green]")
         
+        # Shuffle the papers through a permutation of the row indices, the same one as Dataset.shuffle(seed=42).
+        # Deduplication and sampling only narrow down these indices, and the dataset is selected once at the end,
+        # so the full texts are never rewritten or read through several layers of indices
+        indices = np.random.default_rng(42).permutation(len(input_dataset))
+        
         # Remove duplicates in the dataset
-        original_size = len(input_dataset)
+        original_size = len(indices)
         # First try to remove duplicates based on paper_link if available
         if 'paper_link' in input_dataset.column_names:
-            # Get unique papers based on paper_link
+            # Get unique papers based on paper_link, reading only that column instead of every full text.
+            # The column is read as one Arrow array, indexing the dataset column would read it row by row
+            paper_links = input_dataset.select_columns(['paper_link']).with_format("arrow")[:]['paper_link'].to_pylist()
             unique_links = set()
             unique_indices = []
             
-            for i, paper in enumerate(input_dataset):
-                link = paper['paper_link']
+            for i in indices.tolist():
+                link = paper_links[i]
                 if link not in unique_links:
                     unique_links.add(link)
                     unique_indices.append(i)
-
             
-            input_dataset = input_dataset.select(unique_indices)
-            console.print(f"[yellow]Removed {original_size - len(input_dataset)} duplicate papers based on paper_link[/yellow]")
+            indices = np.array(unique_indices, dtype=np.int64)
+            console.print(f"[yellow]Removed {original_size - len(indices)} duplicate papers based on paper_link[/yellow]")
                 
-        console.print(f"[green]After removing duplicates, {len(input_dataset)} papers remain[/green]")
+        console.print(f"[green]After removing duplicates, {len(indices)} papers remain[/green]")
         if sample_papers:
             # Select papers with indices
             start_index = 0
             end_index = sample_papers
             # Make sure indices are within dataset bounds
-            end_index = min(end_index, len(input_dataset))
+            end_index = min(end_index, len(indices))
 
-            indices = range(start_index, end_index)
-            input_dataset = input_dataset.select(indices)
+            indices = indices[start_index:end_index]
             output_path = f"{output_path}_{start_index}_{end_index}"
             console.print(f"[yellow]Selected papers from index {start_index} to {end_index-1}, saving to {output_path}[/yellow]")
+        if num_jobs > 1:
+            # Every job shuffles the papers the same way, so their contiguous parts do not overlap
+            indices = np.array_split(indices, num_jobs)[job_index]
+            console.print(f"[yellow]Job {job_index + 1}/{num_jobs} processes {len(indices)} papers[/yellow]")
+        input_dataset = input_dataset.select(indices)
         
-        total_theorems = 0
-        total_unique_theorems = 0
+        # Papers without a link are named after their position
+        if 'paper_link' not in input_dataset.column_names:
+            input_dataset = input_dataset.add_column('paper_link', [f"paper_{i}" for i in range(len(input_dataset))])
         
-        for i, paper in enumerate(input_dataset):
-            console.print(
-                Panel(f"Processing paper {i+1} / {len(input_dataset)}", title="Processing Paper", border_style="green")
-            )
-            
-            latex_text = paper['full_text']
-            paper_link = paper.get('paper_link', f"paper_{i}")
-            unique_theorems, num_theorems = self.process_paper(latex_text, skip_appendix, paper_link)
-            total_theorems += num_theorems
-            total_unique_theorems += len(unique_theorems)
-            
-            console.print(f"[green]Found {len(unique_theorems)} high-quality theorems out of {num_theorems} total[/green]")
-            
-            # Add theorems to our collections
-            for theorem in unique_theorems:
-                all_ids.append(len(all_ids))
-                all_paper_links.append(paper_link)
-                all_contexts.append(theorem['context'])
-                all_theorems.append(theorem['theorem'])
-                all_unique_answer_explanations.append(theorem['unique_answer_explanation'])
+        # Extract the candidate theorems of all papers first, one row per theorem. This is pure
+        # CPU-bound regex work, so it is spread over several processes. The papers are read from the
+        # memory-mapped input a few at a time and the candidates are written to disk as they come, so
+        # the memory used does not grow with the number of papers
+        candidates = input_dataset.map(
+            _extract_candidates,
+            batched=True,
+            batch_size=EXTRACTION_BATCH_SIZE,
+            num_proc=num_proc,
+            remove_columns=input_dataset.column_names,
+            features=_CANDIDATE_FEATURES,
+            fn_kwargs={'skip_appendix': skip_appendix, 'context_window': context_window, 'cache_path': extraction_cache_path},
+            desc="Extracting theorems",
+        )
+        total_theorems = candidates.num_rows
+        
+        # Remove duplicate theorems before evaluating them, so that they cost neither requests nor storage
+        candidates = remove_duplicates(candidates, num_proc=num_proc)
+        if near_duplicate_threshold is not None:
+            candidates = remove_near_duplicates(candidates, near_duplicate_threshold)
+        num_candidates = candidates.num_rows
+        
+        # Then evaluate the theorems shard by shard, keeping only the theorems with a single, definitive answer
+        console.print(f"[bold]Evaluating {num_candidates} theorems from {len(input_dataset)} papers[/bold]")
+        shards_path = shards_path or f"{output_path}_shards"
+        shard_paths = []
+        incomplete_shards = []
+        
+        # The shards are only valid for the candidates and the shard size they were evaluated with. Shards left
+        # by a run on other papers or with other settings are cleared instead of being mixed into this one
+        manifest = {'candidates_fingerprint': candidates._fingerprint, 'shard_size': shard_size}
+        manifest_path = os.path.join(shards_path, "manifest.json")
+        if os.path.exists(shards_path):
+            previous_manifest = None
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    previous_manifest = json.load(f)
+            if previous_manifest != manifest:
+                console.print(f"[yellow]Shards in {shards_path} were evaluated for other theorems, clearing them[/yellow]")
+                shutil.rmtree(shards_path)
+        os.makedirs(shards_path, exist_ok=True)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+        
+        def _save_shard(shard, shard_path):
+            # Shards without any unique theorem are only marked as evaluated, empty datasets cannot be loaded back
+            if not shard['theorem']:
+                open(shard_path + ".empty", "w").close()
+                return
+            # Save under a temporary name first, so that an interrupted save is not mistaken for a finished shard
+            Dataset.from_dict(shard, features=_SHARD_FEATURES).save_to_disk(shard_path + ".tmp")
+            os.replace(shard_path + ".tmp", shard_path)
+        
+        async def _evaluate_shards():
+            # All shards run in a single event loop, which the async OpenAI client is bound to.
+            # Every shard is saved in a background thread while the next one is evaluated
+            pending_shards = []
+            for k, start in enumerate(range(0, num_candidates, shard_size)):
+                shard_path = os.path.join(shards_path, f"shard_{k:05d}")
+                shard_paths.append(shard_path)
+                if os.path.exists(shard_path) or os.path.exists(shard_path + ".empty"):
+                    console.print(f"[yellow]Shard {k} already evaluated in {shard_path}, skipping[/yellow]")
+                    continue
+                pending_shards.append((k, start, shard_path))
             
-            # Print running totals after each paper
-            console.print(f"[cyan]Running totals - Total theorems found: {total_theorems}, High-quality theorems: {total_unique_theorems}, Dataset size: {len(all_ids)}[/cyan]")
+            if use_batch_api and pending_shards:
+                # The batches of all the shards are submitted at once and run at the same time, rather than
+                # waiting for the turnaround of every batch in turn. Only the theorems are read for them
+                theorems = candidates.select_columns(['theorem'])
+                batch_results = await asyncio.to_thread(
+                    self.evaluate_theorem_batches,
+                    [theorems[start:start + shard_size]['theorem'] for _, start, _ in pending_shards],
+                )
             
-
+            save_task = None
+            for j, (k, start, shard_path) in enumerate(pending_shards):
+                shard = candidates[start:start + shard_size]
+                if use_batch_api:
+                    results_unique = batch_results[j]
+                else:
+                    results_unique = await self.evaluate_theorems(shard['theorem'])
+                
+                # A shard is only saved once all its theorems were evaluated, failed evaluations are retried on the next run
+                num_failed = sum(1 for result_unique in results_unique if result_unique.get('failed'))
+                if num_failed:
+                    console.print(f"[bold red]{num_failed} theorems of shard {k} could not be evaluated, the shard is not saved[/bold red]")
+                    incomplete_shards.append(k)
+                    continue
+                
+                unique_indices = [i for i, result_unique in enumerate(results_unique) if result_unique['single_unique_answer'] != "false"]
+                shard = {column: [values[i] for i in unique_indices] for column, values in shard.items()}
+                shard['unique_answer_explanation'] = [results_unique[i]['explanation'] for i in unique_indices]
+                if save_task is not None:
+                    await save_task
+                save_task = asyncio.create_task(asyncio.to_thread(_save_shard, shard, shard_path))
+            if save_task is not None:
+                await save_task
         
-        console.print(
-            Panel(
-                f"[bold green]Processing complete![/bold green]\n\n"
-                f"Total papers processed: {len(input_dataset)}\n"
-                f"Total theorems found: {total_theorems}\n"
-                f"Total unique theorems found: {total_unique_theorems}\n",
-                title="Extraction Results",
-                border_style="green"
+        try:
+            asyncio.run(_evaluate_shards())
+        finally:
+            # The evaluations are all done, the cache is not left open for the rest of the run
+            self.close()
+        if incomplete_shards:
+            raise RuntimeError(
+                f"Shards {incomplete_shards} could not be fully evaluated, run again to evaluate them, "
+                f"the saved shards are not evaluated again"
             )
+        
+        shard_paths = [shard_path for shard_path in shard_paths if os.path.exists(shard_path)]
+        if shard_paths:
+            dataset = concatenate_datasets([load_from_disk(shard_path) for shard_path in shard_paths])
+        else:
+            dataset = Dataset.from_dict({column: [] for column in _SHARD_FEATURES}, features=_SHARD_FEATURES)
+        dataset = dataset.add_column('id', list(range(len(dataset))))
+        total_unique_theorems = dataset.num_rows
+        
+        _print_panel(
+            f"[bold green]Processing complete![/bold green]\n\n"
+            f"Total papers processed: {len(input_dataset)}\n"
+            f"Total theorems found: {total_theorems}\n"
+            f"Total theorems after removing duplicates: {num_candidates}\n"
+            f"Total unique theorems found: {total_unique_theorems}\n",
+            title="Extraction Results",
+            border_style="green"
         )
-        # Create the dataset with updated fields
-        dataset = Dataset.from_dict({
-            'id': all_ids,
-            'paper_link': all_paper_links,
-            'context': all_contexts,
-            'theorem': all_theorems,
-            'unique_answer_explanation': all_unique_answer_explanations,
-        })
+        return dataset
+
+
+# Columns identifying duplicate theorems
+DEDUP_KEYS = ['context']
+# Number of rows whose keys are read at once when fingerprinting them
+DEDUP_BATCH_SIZE = 10000
+
+
+def _dedup_fingerprint(key_values):
+    """
+    8-byte fingerprint of the DEDUP_KEYS values of a row, which stands for them when finding duplicates.
+    
+    The values are the UTF-8 bytes of the keys, or None for missing keys. Every value is prefixed with
+    its length, so that different splits of the same text across keys differ.
+    """
+    fingerprint = hashlib.blake2b(digest_size=8)
+    for value in key_values:
+        if value is None:
+            fingerprint.update(b'\xff' * 8)
+            continue
+        fingerprint.update(len(value).to_bytes(8, 'little'))
+        fingerprint.update(value)
+    return fingerprint.digest()
+
+
+def _utf8_values(column):
+    """
+    UTF-8 bytes of the values of an Arrow string column, read in place from its buffers.
+    
+    Args:
+        column (pa.ChunkedArray): String or large string column
         
+    Yields:
+        memoryview: Slice of the data buffer holding a value, or None for a missing value
+    """
+    for chunk in column.chunks:
+        _, offsets, data = chunk.buffers()
+        offset_type = np.int64 if pa.types.is_large_string(chunk.type) else np.int32
+        # Sliced arrays share the buffers of the whole array and start at chunk.offset
+        offsets = np.frombuffer(offsets, dtype=offset_type)[chunk.offset:chunk.offset + len(chunk) + 1].tolist()
+        data = memoryview(data) if data is not None else memoryview(b'')
+        nulls = chunk.is_null().to_numpy(zero_copy_only=False) if chunk.null_count else None
+        for i, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+            yield None if nulls is not None and nulls[i] else data[start:end]
+
+
+# Column of the fingerprints of the rows, computed by _dedup_fingerprints
+_FINGERPRINT_FEATURES = Features({'fingerprint': Value('uint64')})
+
+
+def _dedup_fingerprints(batch):
+    """
+    Fingerprints of a batch of rows as unsigned 64-bit integers, to be used with a batched Dataset.map.
+    
+    The batch is an Arrow table, whose keys are hashed straight from the Arrow buffers without
+    decoding them into Python strings.
+    """
+    key_values = zip(*(_utf8_values(batch.column(key)) for key in DEDUP_KEYS))
+    digests = b"".join(_dedup_fingerprint(values) for values in key_values)
+    return {'fingerprint': np.frombuffer(digests, dtype=np.uint64)}
+
+
+def remove_duplicates(dataset, num_proc=None):
+    """
+    Remove the theorems that repeat the DEDUP_KEYS of an earlier theorem, keeping the first occurrence.
+    
+    The key columns are read batch by batch and only a 64-bit fingerprint of every row is kept, so the
+    memory used does not grow with the size of the keys. Hashing the keys is the costly part and is
+    spread over several processes, while the first row of every fingerprint is found by a single
+    vectorized np.unique over all of them.
+    
+    Args:
+        dataset (Dataset): Dataset with the DEDUP_KEYS columns
+        num_proc (int, optional): Number of processes fingerprinting the rows
         
+    Returns:
+        Dataset: Dataset without the duplicate theorems
+    """
+    num_rows = dataset.num_rows
+    first_rows = np.zeros(0, dtype=np.int64)
+    # Dataset.map leaves empty datasets untouched, without a fingerprint column
+    if num_rows:
+        fingerprints = dataset.select_columns(DEDUP_KEYS).with_format("arrow").map(
+            _dedup_fingerprints,
+            batched=True,
+            batch_size=DEDUP_BATCH_SIZE,
+            num_proc=num_proc,
+            remove_columns=DEDUP_KEYS,
+            features=_FINGERPRINT_FEATURES,
+            desc="Fingerprinting theorems",
+        )
+        fingerprints = fingerprints.with_format("numpy")[:]["fingerprint"]
+        _, first_rows = np.unique(fingerprints, return_index=True)
+    dataset = dataset.select(np.sort(first_rows))
+    # The counts are known from the fingerprints, without counting the rows of the datasets again
+    print(f"length of dataset before removing duplicates: {num_rows}")
+    print(f"length of dataset after removing duplicates: {len(first_rows)}")
+    return dataset
+
+
+def _theorem_shingles(theorem, shingle_size):
+    """Shingles of consecutive LaTeX tokens of a theorem, so that whitespace and formatting do not matter."""
+    tokens = _LATEX_TOKEN_RE.findall(theorem)
+    if len(tokens) <= shingle_size:
+        return {' '.join(tokens)}
+    return {' '.join(tokens[i:i + shingle_size]) for i in range(len(tokens) - shingle_size + 1)}
+
+
+def remove_near_duplicates(dataset, threshold, num_perm=128, shingle_size=5):
+    """
+    Remove the theorems whose statement is nearly the same as an earlier theorem, keeping the first occurrence.
+    
+    Statements are compared through MinHash signatures of their token shingles, indexed in an LSH, which
+    catches theorems restated with different spacing or small notational changes.
+    
+    Args:
+        dataset (Dataset): Dataset with a theorem column
+        threshold (float): Estimated Jaccard similarity above which two theorems are duplicates
+        num_perm (int): Number of permutations of the MinHash signatures
+        shingle_size (int): Number of consecutive tokens in a shingle
         
-        return dataset
+    Returns:
+        Dataset: Dataset without the near-duplicate theorems
+    """
+    if not DATASKETCH_AVAILABLE:
+        raise ImportError("Removing near-duplicate theorems requires datasketch, install with: pip install datasketch")
+    
+    lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
+    kept_indices = []
+    row = 0
+    for batch in dataset.select_columns(['theorem']).iter(batch_size=DEDUP_BATCH_SIZE):
+        for theorem in batch['theorem']:
+            signature = MinHash(num_perm=num_perm)
+            # All the shingles are hashed in a single vectorized update
+            signature.update_batch([shingle.encode('utf-8') for shingle in _theorem_shingles(theorem, shingle_size)])
+            # Only kept theorems are indexed, so that chains of small changes do not drift away from them
+            if not lsh.query(signature):
+                lsh.insert(row, signature)
+                kept_indices.append(row)
+            row += 1
+    dataset = dataset.select(kept_indices)
+    print(f"length of dataset before removing near-duplicates: {row}")
+    print(f"length of dataset after removing near-duplicates: {len(kept_indices)}")
+    return dataset
 
 
-def remove_duplicates(dataset):
-    seen_contexts = set()
+def job_output_path(output_path, job_index, num_jobs):
+    """Path of the output of one of the jobs splitting the papers between them."""
+    if num_jobs == 1:
+        return output_path
+    return f"{output_path}_job_{job_index:05d}_of_{num_jobs:05d}"
 
-    def is_first_occurrence(example):
-        if example['context'] in seen_contexts:
-            return False
-        seen_contexts.add(example['context'])
-        return True
-    print(f"length of dataset before removing duplicates: {len(dataset)}")
-    dataset = dataset.filter(is_first_occurrence)
-    print(f"length of dataset after removing duplicates: {len(dataset)}")
+
+def merge_job_outputs(output_path, num_jobs, near_duplicate_threshold=None):
+    """
+    Merge the outputs of all the jobs into a single dataset.
+    
+    Theorems found by several jobs are deduplicated again, and the ids are renumbered since every job numbers its theorems from 0.
+    
+    Args:
+        output_path (str): Path to save the output dataset, the jobs saved their outputs next to it
+        num_jobs (int): Number of jobs that processed the papers
+        near_duplicate_threshold (float, optional): Similarity above which theorems are near-duplicates, only exact duplicates are removed if None
+        
+    Returns:
+        Dataset: Dataset of the theorems of all jobs
+    """
+    dataset = concatenate_datasets([
+        load_from_disk(job_output_path(output_path, job_index, num_jobs)) for job_index in range(num_jobs)
+    ])
+    dataset = remove_duplicates(dataset)
+    if near_duplicate_threshold is not None:
+        dataset = remove_near_duplicates(dataset, near_duplicate_threshold)
+    dataset = dataset.remove_columns('id').add_column('id', list(range(len(dataset))))
     return dataset
     
 
@@ -712,16 +1362,36 @@ def main():
     parser.add_argument("--output", type=str, default="theorem_dataset", help="Path to save the output dataset")
     parser.add_argument("--sample_papers", type=int, help="Number of papers to process")
     parser.add_argument("--include_appendix", action="store_true", help="Include theorems from appendices (default: skip appendix theorems)")
+    parser.add_argument("--max_parallel", type=int, default=20, help="Maximum number of concurrent OpenAI requests")
+    parser.add_argument("--use_batch_api", action="store_true", help="Evaluate theorems with the OpenAI Batch API (cheaper, but results can take up to 24h)")
+    parser.add_argument("--num_proc", type=int, default=available_cpu_count(), help="Number of processes extracting theorems from the papers")
+    parser.add_argument("--cache_path", type=str, default=".theorem_cache.db", help="Path of the SQLite cache of theorem evaluations, which concurrent jobs can share (empty to disable)")
+    parser.add_argument("--extraction_cache_path", type=str, default=".extraction_cache.db", help="Path of the SQLite cache of the theorems extracted from every paper (empty to disable)")
+    parser.add_argument("--context_window", type=int, default=DEFAULT_CONTEXT_WINDOW, help="Number of characters of LaTeX kept as context before each theorem (0 to keep everything)")
+    parser.add_argument("--shard_size", type=int, default=5000, help="Number of theorems evaluated and saved together, an interrupted run resumes from the last saved shard")
+    parser.add_argument("--num_jobs", type=int, default=1, help="Number of jobs splitting the papers between them, for example on several machines")
+    parser.add_argument("--job_index", type=int, default=0, help="Index of this job, from 0 to num_jobs - 1")
+    parser.add_argument("--near_duplicate_threshold", type=float, help="Also remove theorems whose statement is this similar (between 0 and 1) to an earlier one, requires datasketch")
+    parser.add_argument("--merge_jobs", action="store_true", help="Merge the outputs of the num_jobs jobs into --output instead of processing papers")
     args = parser.parse_args()
+    if not 0 <= args.job_index < args.num_jobs:
+        parser.error("--job_index must be between 0 and --num_jobs - 1")
+    if args.merge_jobs and args.num_jobs < 2:
+        # A single job already saved its output to --output, which the merge would overwrite while reading it
+        parser.error("--merge_jobs requires --num_jobs greater than 1")
+    if args.near_duplicate_threshold is not None and not DATASKETCH_AVAILABLE:
+        parser.error("--near_duplicate_threshold requires datasketch, install with: pip install datasketch")
+    if args.near_duplicate_threshold is not None and not 0 <= args.near_duplicate_threshold <= 1:
+        parser.error("--near_duplicate_threshold must be between 0 and 1")
     setup_random_seed(seed=42)
+    # Arrow sizes its thread pool from the cores of the machine, not from the CPUs given to this job
+    pa.set_cpu_count(available_cpu_count())
 
-    console.print(
-        Panel(
-            "This tool extracts high-quality theorems from LaTeX papers.\n"
-            "The theorems are filtered for quality, mathematical significance, and proper formatting.",
-            title="Theorem Extractor",
-            border_style="blue"
-        )
+    _print_panel(
+        "This tool extracts high-quality theorems from LaTeX papers.\n"
+        "The theorems are filtered for quality, mathematical significance, and proper formatting.",
+        title="Theorem Extractor",
+        border_style="blue"
     )
     
     # Print appendix status
@@ -732,19 +1402,37 @@ def main():
         console.print("[green]Appendix theorems: INCLUDED[/green]")
         console.print("[green]Theorems from appendices will be included in the output.[/green]")
     
+    if args.merge_jobs:
+        dataset = merge_job_outputs(args.output, args.num_jobs, args.near_duplicate_threshold)
+        dataset.save_to_disk(args.output)
+        console.print(f"[bold] Merged the outputs of {args.num_jobs} jobs into {args.output}[/bold]")
+        return
+    
     # Create an instance of TheoremExtractor
-    extractor = TheoremExtractor()
+    extractor = TheoremExtractor(max_parallel=args.max_parallel, cache_path=args.cache_path)
     
     console.print(f"[bold]Processing dataset of LaTeX papers: {args.input}[/bold]")
+    output_path = job_output_path(args.output, args.job_index, args.num_jobs)
+    shards_path = f"{output_path}_shards"
     dataset = extractor.process_dataset(
         input_path=args.input,
-        output_path=args.output,
+        output_path=output_path,
         sample_papers=args.sample_papers,
         skip_appendix=not args.include_appendix,
+        use_batch_api=args.use_batch_api,
+        num_proc=args.num_proc,
+        shard_size=args.shard_size,
+        shards_path=shards_path,
+        context_window=args.context_window,
+        num_jobs=args.num_jobs,
+        job_index=args.job_index,
+        near_duplicate_threshold=args.near_duplicate_threshold,
+        extraction_cache_path=args.extraction_cache_path,
     )
-    dataset = remove_duplicates(dataset)
-    dataset.save_to_disk(args.output)
-    console.print(f"[bold] Processed dataset saved to {args.output}[/bold]")
+    dataset.save_to_disk(output_path)
+    console.print(f"[bold] Processed dataset saved to {output_path}[/bold]")
+    # The evaluated shards are only needed to resume an interrupted run
+    shutil.rmtree(shards_path, ignore_errors=True)
 
 
 